@@ -0,0 +1,113 @@
+"""Measure user insert throughput against the number of SQLite shards.
+
+    python bench_shards.py --shards 2 4 8 --writers 8 --users 2000
+
+Each writer is a separate process with its own engines, like separate app
+workers. The first row is the SQLITE_SHARDS=1 setup: a single auth.db with
+the default journal and autoincrement ids through SQLiteBackend.
+"""
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_interface import SQLiteBackend, ShardedSQLiteBackend, shard_urls
+from models import Base
+
+
+def make_create_user(urls):
+    """Return a create_user(data) callable; one url means the plain auth.db setup."""
+    if len(urls) == 1:
+        engine = create_engine(urls[0], connect_args={"check_same_thread": False})
+        SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+        def create_user(user_data):
+            db = SessionLocal()
+            try:
+                SQLiteBackend.create_user(db, user_data)
+            finally:
+                db.close()
+        return create_user
+    backend = ShardedSQLiteBackend(urls)
+    return lambda user_data: backend.create_user(None, user_data)
+
+
+def write(urls, worker: int, count: int, barrier, results):
+    create_user = make_create_user(urls)
+    succeeded = failed = 0
+    barrier.wait()
+    for i in range(count):
+        try:
+            create_user({
+                "email": f"bench-{worker}-{i}@example.com",
+                "password_hash": "",
+                "full_name": "Bench User",
+                "is_active": True,
+                "created_at": datetime.utcnow()
+            })
+        except Exception:
+            failed += 1
+        else:
+            succeeded += 1
+    results.put((succeeded, failed))
+
+
+def create_schema(urls):
+    if len(urls) == 1:
+        engine = create_engine(urls[0])
+        Base.metadata.create_all(bind=engine)
+        engine.dispose()
+        return
+    backend = ShardedSQLiteBackend(urls)
+    backend.executor.shutdown()
+    for engine in backend.engines:
+        engine.dispose()
+
+
+def run(urls, writers: int, users: int):
+    """Return (successful writes per second, failed writes)."""
+    create_schema(urls)
+    ctx = multiprocessing.get_context("spawn")
+    # The parent is the extra party: timing starts once every writer has
+    # built its engines, so process start-up is not measured.
+    barrier = ctx.Barrier(writers + 1)
+    results = ctx.Queue()
+    processes = [ctx.Process(target=write, args=(urls, worker, users // writers, barrier, results)) for worker in range(writers)]
+    for process in processes:
+        process.start()
+    barrier.wait()
+    start = time.perf_counter()
+    counts = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - start
+    for process in processes:
+        process.join()
+    return sum(succeeded for succeeded, _ in counts) / elapsed, sum(failed for _, failed in counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark create_user throughput vs. shard count.")
+    parser.add_argument("--shards", type=int, nargs="+", default=[2, 4, 8], help="shard counts to compare with auth.db")
+    parser.add_argument("--writers", type=int, default=8, help="concurrent writer processes")
+    parser.add_argument("--users", type=int, default=2000, help="users inserted per run")
+    args = parser.parse_args()
+
+    print(f"{'setup':>8}  {'writes/s':>10}  {'speedup':>7}  {'failed':>6}")
+    with tempfile.TemporaryDirectory() as tmp:
+        rate, failed = run(["sqlite:///" + os.path.join(tmp, "auth.db")], args.writers, args.users)
+        baseline = rate
+        print(f"{'auth.db':>8}  {rate:>10.0f}  {1:>6.2f}x  {failed:>6}")
+        for shard_count in args.shards:
+            if shard_count < 2:
+                continue
+            template = "sqlite:///" + os.path.join(tmp, f"s{shard_count}_shard_{{shard}}.db")
+            rate, failed = run(shard_urls(template, shard_count), args.writers, args.users)
+            print(f"{shard_count:>2} shards  {rate:>10.0f}  {rate / baseline:>6.2f}x  {failed:>6}")
+
+
+if __name__ == "__main__":
+    main()
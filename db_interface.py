@@ -1,16 +1,41 @@
 import os
-from typing import Optional, Dict, Any
+import hashlib
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, Any, List, Union
 from datetime import datetime
+from email_filter import email_filter, normalize_email
 
 DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")
+# With more than one shard the sqlite backend partitions users across
+# SQLITE_SHARD_URL.format(shard=0..N-1) instead of using the app's auth.db.
+SQLITE_SHARDS = int(os.getenv("SQLITE_SHARDS", "1"))
+SQLITE_SHARD_URL = os.getenv("SQLITE_SHARD_URL", "sqlite:///./auth_shard_{shard}.db")
+
+# Public fields returned by the JSON API; never includes password or reset data.
+USER_RECORD_FIELDS = ("id", "email", "full_name", "is_active", "is_admin", "created_at")
+
+def user_record(user) -> Optional[Dict[str, Any]]:
+    if user is None:
+        return None
+    if isinstance(user, dict):
+        return {field: user.get(field) for field in USER_RECORD_FIELDS}
+    return {field: getattr(user, field, None) for field in USER_RECORD_FIELDS}
 
 # --- SQLite (SQLAlchemy) Backend ---
+from sqlalchemy import or_
+
 class SQLiteBackend:
     from sqlalchemy.orm import Session
     from models import User
 
     @staticmethod
-    def get_user_by_email(db, email: str):
+    def get_user_by_email(db, email: str, use_filter: bool = True):
+        # Write paths pass use_filter=False: the filter can miss writes made
+        # by other processes, so existence checks must ask the database.
+        if use_filter and not email_filter.might_contain(email):
+            return None
         return db.query(SQLiteBackend.User).filter(SQLiteBackend.User.email == email).first()
 
     @staticmethod
@@ -27,30 +52,261 @@ class SQLiteBackend:
         db.add(user)
         db.commit()
         db.refresh(user)
+        email_filter.add(user.email)
         return user
 
     @staticmethod
     def update_user(db, email: str, update_data: dict):
-        user = SQLiteBackend.get_user_by_email(db, email)
+        user = SQLiteBackend.get_user_by_email(db, email, use_filter=False)
         if not user:
             return None
+        old_email = user.email
         for k, v in update_data.items():
             setattr(user, k, v)
         db.commit()
         db.refresh(user)
+        email_filter.replace(old_email, user.email)
         return user
 
     @staticmethod
     def delete_user(db, email: str):
-        user = SQLiteBackend.get_user_by_email(db, email)
+        user = SQLiteBackend.get_user_by_email(db, email, use_filter=False)
         if user:
             db.delete(user)
             db.commit()
+            email_filter.remove(user.email)
 
     @staticmethod
     def get_all_users(db):
         return db.query(SQLiteBackend.User).all()
 
+    @staticmethod
+    def get_user_records(db):
+        columns = [getattr(SQLiteBackend.User, field) for field in USER_RECORD_FIELDS]
+        return [user_record(row) for row in db.query(*columns).order_by(SQLiteBackend.User.id)]
+
+    @staticmethod
+    def get_users_by_ids_or_emails(db, ids: List[int], emails: List[str]):
+        emails = [email for email in emails if email_filter.might_contain(email)]
+        return SQLiteBackend.query_user_records(db, ids, emails)
+
+    @staticmethod
+    def query_user_records(db, ids: List[int], emails: List[str]):
+        if not ids and not emails:
+            return []
+        User = SQLiteBackend.User
+        columns = [getattr(User, field) for field in USER_RECORD_FIELDS]
+        return [user_record(row) for row in db.query(*columns).filter(or_(User.id.in_(ids), User.email.in_(emails))).order_by(User.id)]
+
+    @staticmethod
+    def count_users(db) -> int:
+        return db.query(SQLiteBackend.User).count()
+
+    @staticmethod
+    def rebuild_email_filter(db):
+        expected = db.query(SQLiteBackend.User).count()
+        emails = (row.email for row in db.query(SQLiteBackend.User.email).yield_per(1000))
+        email_filter.rebuild(emails, expected)
+
+# --- Sharded SQLite Backend ---
+from sqlalchemy import create_engine, event, func, select, MetaData, Table, Column, Integer
+from sqlalchemy.orm import sessionmaker
+from models import Base
+
+def shard_urls(template: str, count: int) -> List[str]:
+    return [template.format(shard=shard) for shard in range(count)]
+
+def shard_for_email(email: str, count: int) -> int:
+    # Stable across processes and restarts, unlike hash().
+    digest = hashlib.blake2b(normalize_email(email).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % count
+
+# Shards cannot share the users autoincrement, so each shard hands out
+# sequence numbers from its own table and user ids are
+# (sequence << SHARD_ID_BITS) | shard_index, unique across shards.
+SHARD_ID_BITS = 8
+
+id_sequence = Table(
+    "id_sequence",
+    MetaData(),
+    Column("value", Integer, primary_key=True),
+    sqlite_autoincrement=True,
+)
+
+def create_shard_engine(url: str):
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.close()
+
+    Base.metadata.create_all(bind=engine)
+    id_sequence.metadata.create_all(bind=engine)
+    return engine
+
+class ShardedSQLiteBackend:
+    """Partitions users across SQLite files by a hash of the normalized email.
+
+    Methods take the same ``db`` argument as SQLiteBackend so they can be
+    dispatched interchangeably, but open their own per-shard sessions.
+    """
+    from models import User
+
+    def __init__(self, urls: List[str]):
+        if not urls or len(urls) > 1 << SHARD_ID_BITS:
+            raise ValueError(f"Shard count must be between 1 and {1 << SHARD_ID_BITS}")
+        self.urls = list(urls)
+        self.engines = [create_shard_engine(url) for url in self.urls]
+        self.sessions = [sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine) for engine in self.engines]
+        self.executor = ThreadPoolExecutor(max_workers=len(self.urls), thread_name_prefix="shard")
+        self.seed_id_sequences()
+
+    def seed_id_sequences(self):
+        """Start every shard's sequence above the largest existing user id.
+
+        Rows copied in from auth.db or another shard layout keep their ids,
+        which may use any low bits, so new ids must be larger than all of them.
+        """
+        max_id = max(self.fan_out(lambda db: db.query(func.max(self.User.id)).scalar() or 0))
+        floor = (max_id >> SHARD_ID_BITS) + 1
+        for shard in range(len(self.urls)):
+            with self.session(shard) as db:
+                current = db.execute(select(func.max(id_sequence.c.value))).scalar() or 0
+                if current < floor:
+                    db.execute(id_sequence.insert().prefix_with("OR IGNORE").values(value=floor))
+                    db.commit()
+
+    def next_user_id(self, db, shard: int) -> int:
+        # Runs inside the caller's transaction, so the sequence row and the
+        # user are committed (or rolled back) together.
+        value = db.execute(id_sequence.insert()).inserted_primary_key[0]
+        db.execute(id_sequence.delete().where(id_sequence.c.value < value))
+        return (value << SHARD_ID_BITS) | shard
+
+    def shard_for(self, email: str) -> int:
+        return shard_for_email(email, len(self.urls))
+
+    @contextmanager
+    def session(self, shard: int):
+        db = self.sessions[shard]()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def map_shards(self, fn, shards) -> list:
+        """Run fn(shard) in the pool and return the results in order."""
+        # executor.map does not carry contextvars into the pool threads, so
+        # copy the caller's context per task (the profiler relies on it).
+        futures = [self.executor.submit(contextvars.copy_context().run, fn, shard) for shard in shards]
+        return [future.result() for future in futures]
+
+    def fan_out(self, query) -> list:
+        """Run query(db) on every shard in parallel and return the results in shard order."""
+        def run(shard):
+            with self.session(shard) as db:
+                return query(db)
+        return self.map_shards(run, range(len(self.urls)))
+
+    def _find_by_email(self, db, email: str):
+        return db.query(self.User).filter(self.User.email == email).first()
+
+    def get_user_by_email(self, db, email: str, use_filter: bool = True):
+        if use_filter and not email_filter.might_contain(email):
+            return None
+        with self.session(self.shard_for(email)) as shard_db:
+            return self._find_by_email(shard_db, email)
+
+    def get_user_by_id(self, db, user_id: int):
+        users = self.fan_out(lambda shard_db: SQLiteBackend.get_user_by_id(shard_db, user_id))
+        return next((user for user in users if user), None)
+
+    def get_user_by_reset_token(self, db, token: str):
+        users = self.fan_out(lambda shard_db: SQLiteBackend.get_user_by_reset_token(shard_db, token))
+        return next((user for user in users if user), None)
+
+    def create_user(self, db, user_data: dict):
+        shard = self.shard_for(user_data["email"])
+        with self.session(shard) as shard_db:
+            if "id" not in user_data:
+                user_data = {"id": self.next_user_id(shard_db, shard), **user_data}
+            return SQLiteBackend.create_user(shard_db, user_data)
+
+    def update_user(self, db, email: str, update_data: dict):
+        shard = self.shard_for(email)
+        with self.session(shard) as shard_db:
+            user = self._find_by_email(shard_db, email)
+            if not user:
+                return None
+            new_shard = self.shard_for(update_data.get("email", email))
+            if new_shard == shard:
+                for k, v in update_data.items():
+                    setattr(user, k, v)
+                shard_db.commit()
+                shard_db.refresh(user)
+                email_filter.replace(email, user.email)
+                return user
+            user_data = {column.name: getattr(user, column.name) for column in self.User.__table__.columns}
+            user_data.update(update_data)
+        # The new email hashes to another shard: write the moved row before
+        # deleting the old one so a failure leaves a duplicate, not a loss.
+        with self.session(new_shard) as new_db:
+            moved = self.User(**user_data)
+            new_db.add(moved)
+            new_db.commit()
+            new_db.refresh(moved)
+        with self.session(shard) as shard_db:
+            shard_db.query(self.User).filter(self.User.id == moved.id).delete()
+            shard_db.commit()
+        email_filter.replace(email, moved.email)
+        return moved
+
+    def delete_user(self, db, email: str):
+        with self.session(self.shard_for(email)) as shard_db:
+            user = self._find_by_email(shard_db, email)
+            if user:
+                shard_db.delete(user)
+                shard_db.commit()
+                email_filter.remove(user.email)
+
+    def get_all_users(self, db):
+        users = [user for shard_users in self.fan_out(SQLiteBackend.get_all_users) for user in shard_users]
+        return sorted(users, key=lambda user: user.id)
+
+    def get_user_records(self, db):
+        records = [record for shard_records in self.fan_out(SQLiteBackend.get_user_records) for record in shard_records]
+        return sorted(records, key=lambda record: record["id"])
+
+    def get_users_by_ids_or_emails(self, db, ids: List[int], emails: List[str]):
+        emails = [email for email in emails if email_filter.might_contain(email)]
+        if not ids and not emails:
+            return []
+        # Ids can live on any shard; emails only need their own shard.
+        emails_by_shard: Dict[int, List[str]] = {}
+        for email in emails:
+            emails_by_shard.setdefault(self.shard_for(email), []).append(email)
+        shards = range(len(self.urls)) if ids else sorted(emails_by_shard)
+        results = self.map_shards(lambda shard: self._query_shard_records(shard, ids, emails_by_shard.get(shard, [])), shards)
+        return sorted((record for shard_records in results for record in shard_records), key=lambda record: record["id"])
+
+    def _query_shard_records(self, shard: int, ids: List[int], emails: List[str]):
+        with self.session(shard) as shard_db:
+            return SQLiteBackend.query_user_records(shard_db, ids, emails)
+
+    def count_users(self, db) -> int:
+        return sum(self.fan_out(SQLiteBackend.count_users))
+
+    def iter_emails(self):
+        for shard in range(len(self.urls)):
+            with self.session(shard) as shard_db:
+                for row in shard_db.query(self.User.email).yield_per(1000):
+                    yield row.email
+
+    def rebuild_email_filter(self, db):
+        email_filter.rebuild(self.iter_emails(), self.count_users(db))
+
 # --- MongoDB (Motor) Backend ---
 from motor.motor_asyncio import AsyncIOMotorClient
 from pydantic import BaseModel, EmailStr, Field
@@ -61,6 +317,12 @@ client = AsyncIOMotorClient(MONGO_URL)
 mongo_db = client["auth_db"]
 users_collection = mongo_db["users"]
 
+def user_id_query(user_id: Union[int, str]) -> Dict[str, Any]:
+    # Users are exposed with id = str(_id); older callers pass a numeric id.
+    if isinstance(user_id, str) and ObjectId.is_valid(user_id) and len(user_id) == 24:
+        return {"_id": ObjectId(user_id)}
+    return {"id": user_id}
+
 class UserModel(BaseModel):
     id: Optional[str]
     email: EmailStr
@@ -74,7 +336,9 @@ class UserModel(BaseModel):
 
 class MongoBackend:
     @staticmethod
-    async def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
+    async def get_user_by_email(email: str, use_filter: bool = True) -> Optional[Dict[str, Any]]:
+        if use_filter and not email_filter.might_contain(email):
+            return None
         user = await users_collection.find_one({"email": email})
         if user:
             user["id"] = str(user["_id"])
@@ -82,8 +346,8 @@ class MongoBackend:
         return user
 
     @staticmethod
-    async def get_user_by_id(user_id: int) -> Optional[Dict[str, Any]]:
-        user = await users_collection.find_one({"id": user_id})
+    async def get_user_by_id(user_id: Union[int, str]) -> Optional[Dict[str, Any]]:
+        user = await users_collection.find_one(user_id_query(user_id))
         if user:
             user["id"] = str(user["_id"])
             user["email"] = user.get("email")
@@ -101,15 +365,20 @@ class MongoBackend:
     @staticmethod
     async def create_user(user_data: dict) -> str:
         result = await users_collection.insert_one(user_data)
+        email_filter.add(user_data.get("email"))
         return str(result.inserted_id)
 
     @staticmethod
     async def update_user(email: str, update_data: dict):
-        await users_collection.update_one({"email": email}, {"$set": update_data})
+        result = await users_collection.update_one({"email": email}, {"$set": update_data})
+        if result.matched_count and "email" in update_data:
+            email_filter.replace(email, update_data["email"])
 
     @staticmethod
     async def delete_user(email: str):
-        await users_collection.delete_one({"email": email})
+        result = await users_collection.delete_one({"email": email})
+        if result.deleted_count:
+            email_filter.remove(email)
 
     @staticmethod
     async def get_all_users():
@@ -120,8 +389,56 @@ class MongoBackend:
             users.append(user)
         return users
 
+    @staticmethod
+    async def get_user_records():
+        projection = {field: 1 for field in USER_RECORD_FIELDS}
+        records = []
+        async for user in users_collection.find({}, projection).sort("_id", 1):
+            user["id"] = str(user["_id"])
+            records.append(user_record(user))
+        return records
+
+    @staticmethod
+    async def get_users_by_ids_or_emails(ids: List[Union[int, str]], emails: List[str]):
+        emails = [email for email in emails if email_filter.might_contain(email)]
+        if not ids and not emails:
+            return []
+        projection = {field: 1 for field in USER_RECORD_FIELDS}
+        id_queries = [user_id_query(user_id) for user_id in ids]
+        object_ids = [q["_id"] for q in id_queries if "_id" in q]
+        legacy_ids = [q["id"] for q in id_queries if "id" in q]
+        query = {"$or": [{"_id": {"$in": object_ids}}, {"id": {"$in": legacy_ids}}, {"email": {"$in": emails}}]}
+        records = []
+        async for user in users_collection.find(query, projection).sort("_id", 1):
+            user["id"] = str(user["_id"])
+            records.append(user_record(user))
+        return records
+
+    @staticmethod
+    async def count_users() -> int:
+        return await users_collection.count_documents({})
+
+    @staticmethod
+    async def rebuild_email_filter():
+        expected = await users_collection.count_documents({})
+        emails = [doc.get("email") async for doc in users_collection.find({}, {"email": 1})]
+        email_filter.rebuild(emails, expected)
+
 # --- Dispatch functions ---
-if DB_BACKEND == "sqlite":
+if DB_BACKEND == "sqlite" and SQLITE_SHARDS > 1:
+    sharded_backend = ShardedSQLiteBackend(shard_urls(SQLITE_SHARD_URL, SQLITE_SHARDS))
+    get_user_by_email = sharded_backend.get_user_by_email
+    get_user_by_id = sharded_backend.get_user_by_id
+    get_user_by_reset_token = sharded_backend.get_user_by_reset_token
+    create_user = sharded_backend.create_user
+    update_user = sharded_backend.update_user
+    delete_user = sharded_backend.delete_user
+    get_all_users = sharded_backend.get_all_users
+    get_user_records = sharded_backend.get_user_records
+    get_users_by_ids_or_emails = sharded_backend.get_users_by_ids_or_emails
+    count_users = sharded_backend.count_users
+    rebuild_email_filter = sharded_backend.rebuild_email_filter
+elif DB_BACKEND == "sqlite":
     get_user_by_email = SQLiteBackend.get_user_by_email
     get_user_by_id = SQLiteBackend.get_user_by_id
     get_user_by_reset_token = SQLiteBackend.get_user_by_reset_token
@@ -129,6 +446,10 @@ if DB_BACKEND == "sqlite":
     update_user = SQLiteBackend.update_user
     delete_user = SQLiteBackend.delete_user
     get_all_users = SQLiteBackend.get_all_users
+    get_user_records = SQLiteBackend.get_user_records
+    get_users_by_ids_or_emails = SQLiteBackend.get_users_by_ids_or_emails
+    count_users = SQLiteBackend.count_users
+    rebuild_email_filter = SQLiteBackend.rebuild_email_filter
 else:
     get_user_by_email = MongoBackend.get_user_by_email
     get_user_by_id = MongoBackend.get_user_by_id
@@ -136,4 +457,8 @@ else:
     create_user = MongoBackend.create_user
     update_user = MongoBackend.update_user
     delete_user = MongoBackend.delete_user
-    get_all_users = MongoBackend.get_all_users 
\ No newline at end of file
+    get_all_users = MongoBackend.get_all_users
+    get_user_records = MongoBackend.get_user_records
+    get_users_by_ids_or_emails = MongoBackend.get_users_by_ids_or_emails
+    count_users = MongoBackend.count_users
+    rebuild_email_filter = MongoBackend.rebuild_email_filter 
\ No newline at end of file
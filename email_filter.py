@@ -0,0 +1,175 @@
+import os
+import math
+import hashlib
+import logging
+import threading
+from typing import Iterable, Optional, Dict, Any, List
+
+logger = logging.getLogger(__name__)
+
+# Process-local negative-lookup filter for user emails. A miss means the
+# email is not in the users table as this process last saw it, so lookups
+# can skip the database. Writes made by other processes are only picked up
+# by the periodic rebuild, so a miss can be stale: SQLite creates rely on the
+# unique email constraint to catch that, while checks with no constraint
+# behind them (MongoDB, profile email changes) pass use_filter=False. The
+# filter also refuses to run with more than one worker.
+EMAIL_FILTER_ENABLED = os.getenv("EMAIL_FILTER_ENABLED", "0") not in ("0", "false", "False", "")
+EMAIL_FILTER_CAPACITY = int(os.getenv("EMAIL_FILTER_CAPACITY", "100000"))
+EMAIL_FILTER_FP_RATE = float(os.getenv("EMAIL_FILTER_FP_RATE", "0.01"))
+EMAIL_FILTER_REBUILD_SECONDS = float(os.getenv("EMAIL_FILTER_REBUILD_SECONDS", "300"))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+_COUNTER_MAX = 255
+
+
+def normalize_email(email: str) -> str:
+    return email.strip().lower()
+
+
+class CountingBloomFilter:
+    """Bloom filter with 8-bit counters so emails can be removed again."""
+
+    def __init__(self, capacity: int, fp_rate: float):
+        capacity = max(1, capacity)
+        fp_rate = min(max(fp_rate, 1e-9), 0.5)
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(fp_rate) / (math.log(2) ** 2))))
+        self.num_hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.counters = bytearray(self.size)
+        self.count = 0
+
+    def _positions(self, email: str):
+        digest = hashlib.blake2b(normalize_email(email).encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.num_hashes)]
+
+    def add(self, email: str):
+        for pos in self._positions(email):
+            if self.counters[pos] < _COUNTER_MAX:
+                self.counters[pos] += 1
+        self.count += 1
+
+    def remove(self, email: str):
+        # Only call for emails that were added, otherwise counters shared
+        # with other emails get decremented and lookups can miss.
+        positions = self._positions(email)
+        if not all(self.counters[pos] for pos in positions):
+            return
+        for pos in positions:
+            # Saturated counters have lost their exact value; leave them set.
+            if self.counters[pos] < _COUNTER_MAX:
+                self.counters[pos] -= 1
+        self.count = max(0, self.count - 1)
+
+    def __contains__(self, email: str) -> bool:
+        return all(self.counters[pos] for pos in self._positions(email))
+
+    def estimated_fp_rate(self) -> float:
+        if not self.count:
+            return 0.0
+        return (1 - math.exp(-self.num_hashes * self.count / self.size)) ** self.num_hashes
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "entries": self.count,
+            "target_fp_rate": self.fp_rate,
+            "estimated_fp_rate": self.estimated_fp_rate(),
+            "counters": self.size,
+            "hash_functions": self.num_hashes,
+            "memory_bytes": len(self.counters),
+        }
+
+
+class EmailFilter:
+    """Holds the active filter and hit/miss counters for get_user_by_email."""
+
+    def __init__(self, enabled: bool = EMAIL_FILTER_ENABLED, capacity: int = EMAIL_FILTER_CAPACITY, fp_rate: float = EMAIL_FILTER_FP_RATE, workers: int = WEB_CONCURRENCY):
+        if enabled and workers > 1:
+            logger.warning("Email filter disabled: it is per-process and WEB_CONCURRENCY=%d", workers)
+            enabled = False
+        self.enabled = enabled
+        self.capacity = capacity
+        self.fp_rate = fp_rate
+        self.bloom: Optional[CountingBloomFilter] = None
+        self.skipped_lookups = 0
+        self.passed_lookups = 0
+        self._lock = threading.Lock()
+        # Emails added while a rebuild is streaming the table; replayed into
+        # the new filter so they are not lost when it is swapped in.
+        self._pending: Optional[List[str]] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.enabled and self.bloom is not None
+
+    def rebuild(self, emails: Iterable[str], expected: int = 0):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending = []
+        try:
+            # Leave headroom so the false-positive rate holds as users sign up.
+            bloom = CountingBloomFilter(max(self.capacity, expected * 2), self.fp_rate)
+            for email in emails:
+                if email:
+                    bloom.add(email)
+            with self._lock:
+                for email in self._pending:
+                    bloom.add(email)
+                self.bloom = bloom
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def might_contain(self, email: str) -> bool:
+        """False only when the email is definitely not stored."""
+        if not self.ready or not email:
+            return True
+        if email in self.bloom:
+            self.passed_lookups += 1
+            return True
+        self.skipped_lookups += 1
+        return False
+
+    def add(self, email: Optional[str]):
+        if not self.enabled or not email:
+            return
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(email)
+            if self.bloom is not None:
+                self.bloom.add(email)
+
+    def remove(self, email: Optional[str]):
+        if not self.ready or not email:
+            return
+        with self._lock:
+            # During a rebuild the new filter may not hold this email yet, so
+            # removing from it could hide other emails; keep the stale entry.
+            if self._pending is None:
+                self.bloom.remove(email)
+
+    def replace(self, old_email: Optional[str], new_email: Optional[str]):
+        if old_email == new_email:
+            return
+        self.add(new_email)
+        self.remove(old_email)
+
+    def stats(self) -> Dict[str, Any]:
+        stats: Dict[str, Any] = {
+            "enabled": self.enabled,
+            "ready": self.ready,
+            "rebuild_seconds": EMAIL_FILTER_REBUILD_SECONDS,
+            "skipped_lookups": self.skipped_lookups,
+            "passed_lookups": self.passed_lookups,
+        }
+        if self.bloom is not None:
+            stats.update(self.bloom.stats())
+        return stats
+
+
+email_filter = EmailFilter()
@@ -1,35 +1,78 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, Form, status
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request, Form, status
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, Mapped, mapped_column
+from sqlalchemy.exc import IntegrityError
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 import jwt
-from typing import Optional, TYPE_CHECKING
+from typing import Optional, List, Union, TYPE_CHECKING
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import secrets
 import os
+import asyncio
+import logging
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 from authlib.integrations.starlette_client import OAuth
 from starlette.config import Config
 from starlette.requests import Request as StarletteRequest
+from pydantic import BaseModel, EmailStr
 import db_interface
+from email_filter import email_filter, EMAIL_FILTER_REBUILD_SECONDS
+from profiling import profiler, folded_stacks, ProfilingMiddleware
 from models import User, Base
 
 # Load environment variables
 load_dotenv()
 FRONTEND_URL = os.getenv("FRONTEND_URL", "https://template-dhcd.onrender.com")
+logger = logging.getLogger(__name__)
+
+# Email filter lifecycle
+def rebuild_sqlite_email_filter():
+    db = SessionLocal()
+    try:
+        db_interface.rebuild_email_filter(db)
+    finally:
+        db.close()
+
+async def build_email_filter():
+    if DB_BACKEND == "sqlite":
+        await asyncio.to_thread(rebuild_sqlite_email_filter)
+    else:
+        await db_interface.rebuild_email_filter()
+
+async def refresh_email_filter():
+    # Picks up users written by other processes (scripts, manual edits).
+    while True:
+        await asyncio.sleep(EMAIL_FILTER_REBUILD_SECONDS)
+        try:
+            await build_email_filter()
+        except Exception:
+            logger.exception("Email filter rebuild failed")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    refresh_task = None
+    if email_filter.enabled:
+        await build_email_filter()
+        if EMAIL_FILTER_REBUILD_SECONDS > 0:
+            refresh_task = asyncio.create_task(refresh_email_filter())
+    yield
+    if refresh_task:
+        refresh_task.cancel()
 
 # App configuration
-app = FastAPI(title="Simple Auth System")
+app = FastAPI(title="Simple Auth System", lifespan=lifespan)
 templates = Jinja2Templates(directory="templates")
 app.mount("/static", StaticFiles(directory="static"), name="static")
+app.add_middleware(ProfilingMiddleware)
 
 # Database setup
 DATABASE_URL = "sqlite:///./auth.db"
@@ -41,6 +84,7 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "7"))
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
@@ -76,6 +120,15 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def create_sqlite_user(db, user_data: dict):
+    # SQLite callers check existence through the email filter; the unique
+    # email constraint catches the rare stale miss. Returns None if taken.
+    try:
+        return db_interface.create_user(db, user_data)
+    except IntegrityError:
+        db.rollback()
+        return None
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -86,9 +139,14 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str):
+def create_refresh_token(data: dict):
+    return create_access_token({**data, "type": "refresh"}, timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS))
+
+def verify_token(token: str, token_type: str = "access"):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        if payload.get("type", "access") != token_type:
+            return None
         email: str = payload.get("sub")
         if email is None:
             return None
@@ -190,7 +248,7 @@ async def register_user(
     if DB_BACKEND == "sqlite":
         if db_interface.get_user_by_email(db, email):
             return templates.TemplateResponse("register.html", {"request": request, "error": "Email already registered"})
-        is_first_user = db.query(User).count() == 0
+        is_first_user = db_interface.count_users(db) == 0
         hashed_password = get_password_hash(password)
         user_data = {
             "email": email,
@@ -198,12 +256,13 @@ async def register_user(
             "full_name": full_name,
             "is_admin": is_first_user
         }
-        db_interface.create_user(db, user_data)
+        if not create_sqlite_user(db, user_data):
+            return templates.TemplateResponse("register.html", {"request": request, "error": "Email already registered"})
     else:
-        user = await db_interface.get_user_by_email(email)
+        user = await db_interface.get_user_by_email(email, use_filter=False)
         if user:
             return templates.TemplateResponse("register.html", {"request": request, "error": "Email already registered"})
-        is_first_user = (await db_interface.get_all_users()).__len__() == 0
+        is_first_user = await db_interface.count_users() == 0
         hashed_password = get_password_hash(password)
         user_data = {
             "email": email,
@@ -257,7 +316,7 @@ async def auth_google_callback(request: StarletteRequest, db: Session = Depends(
     if DB_BACKEND == "sqlite":
         user = db_interface.get_user_by_email(db, email)
     else:
-        user = await db_interface.get_user_by_email(email)
+        user = await db_interface.get_user_by_email(email, use_filter=False)
     if not user:
         user_data = {
             "email": email,
@@ -266,7 +325,7 @@ async def auth_google_callback(request: StarletteRequest, db: Session = Depends(
             "is_active": True
         }
         if DB_BACKEND == "sqlite":
-            db_interface.create_user(db, user_data)
+            user = create_sqlite_user(db, user_data) or db_interface.get_user_by_email(db, email, use_filter=False)
         else:
             await db_interface.create_user(user_data)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -300,7 +359,7 @@ async def auth_github_callback(request: StarletteRequest, db: Session = Depends(
     if DB_BACKEND == "sqlite":
         user = db_interface.get_user_by_email(db, email)
     else:
-        user = await db_interface.get_user_by_email(email)
+        user = await db_interface.get_user_by_email(email, use_filter=False)
     if not user:
         user_data = {
             "email": email,
@@ -309,7 +368,7 @@ async def auth_github_callback(request: StarletteRequest, db: Session = Depends(
             "is_active": True
         }
         if DB_BACKEND == "sqlite":
-            db_interface.create_user(db, user_data)
+            user = create_sqlite_user(db, user_data) or db_interface.get_user_by_email(db, email, use_filter=False)
         else:
             await db_interface.create_user(user_data)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -439,9 +498,9 @@ async def update_profile(
     
     # Check if email is already taken by another user
     if DB_BACKEND == "sqlite":
-        existing_user = db_interface.get_user_by_email(db, email)
+        existing_user = db_interface.get_user_by_email(db, email, use_filter=False)
     else:
-        existing_user = await db_interface.get_user_by_email(email)
+        existing_user = await db_interface.get_user_by_email(email, use_filter=False)
 
     if existing_user and existing_user.id != user.id:
         return templates.TemplateResponse("profile.html", {
@@ -566,9 +625,10 @@ async def admin_add_user(request: Request, full_name: str = Form(...), email: st
             "is_active": True,
             "created_at": datetime.utcnow()
         }
-        db_interface.create_user(db, user_data)
+        if not create_sqlite_user(db, user_data):
+            return templates.TemplateResponse("admin_add_user.html", {"request": request, "admin": admin, "error": "Email already registered"})
     else:
-        user = await db_interface.get_user_by_email(email)
+        user = await db_interface.get_user_by_email(email, use_filter=False)
         if user:
             return templates.TemplateResponse("admin_add_user.html", {"request": request, "admin": admin, "error": "Email already registered"})
         hashed_password = get_password_hash(password)
@@ -581,4 +641,255 @@ async def admin_add_user(request: Request, full_name: str = Form(...), email: st
             "created_at": datetime.utcnow()
         }
         await db_interface.create_user(user_data)
-    return RedirectResponse(url="/admin", status_code=302)
\ No newline at end of file
+    return RedirectResponse(url="/admin", status_code=302)
+
+@app.get("/admin/email-filter")
+async def admin_email_filter_stats(request: Request, db: Session = Depends(get_db)):
+    admin = get_current_user(request, db)
+    if not admin or not bool(admin.is_admin if DB_BACKEND == "sqlite" else admin.get("is_admin", False)):
+        return RedirectResponse(url="/login", status_code=302)
+    return JSONResponse(email_filter.stats())
+
+@app.get("/admin/profiling")
+async def admin_profiling_status(request: Request, db: Session = Depends(get_db)):
+    admin = get_current_user(request, db)
+    if not admin or not bool(admin.is_admin if DB_BACKEND == "sqlite" else admin.get("is_admin", False)):
+        return RedirectResponse(url="/login", status_code=302)
+    return JSONResponse(profiler.stats())
+
+@app.post("/admin/profiling")
+async def admin_profiling_configure(request: Request, enabled: Optional[bool] = Form(None), sample_rate: Optional[float] = Form(None), path_prefix: Optional[str] = Form(None), threshold_ms: Optional[float] = Form(None), clear_path_prefix: bool = Form(False), db: Session = Depends(get_db)):
+    admin = get_current_user(request, db)
+    if not admin or not bool(admin.is_admin if DB_BACKEND == "sqlite" else admin.get("is_admin", False)):
+        return RedirectResponse(url="/login", status_code=302)
+    # Fields that are not posted keep their current value.
+    profiler.configure(enabled, sample_rate, "" if clear_path_prefix else path_prefix, threshold_ms)
+    return JSONResponse(profiler.stats())
+
+@app.get("/admin/profiling/traces/{trace_id}")
+async def admin_profiling_trace(request: Request, trace_id: int, db: Session = Depends(get_db)):
+    admin = get_current_user(request, db)
+    if not admin or not bool(admin.is_admin if DB_BACKEND == "sqlite" else admin.get("is_admin", False)):
+        return RedirectResponse(url="/login", status_code=302)
+    trace = profiler.get_trace(trace_id)
+    if not trace:
+        return JSONResponse({"detail": "Trace not found"}, status_code=404)
+    return JSONResponse(trace)
+
+@app.get("/admin/profiling/traces/{trace_id}/folded")
+async def admin_profiling_trace_folded(request: Request, trace_id: int, db: Session = Depends(get_db)):
+    admin = get_current_user(request, db)
+    if not admin or not bool(admin.is_admin if DB_BACKEND == "sqlite" else admin.get("is_admin", False)):
+        return RedirectResponse(url="/login", status_code=302)
+    trace = profiler.get_trace(trace_id)
+    if not trace:
+        return PlainTextResponse("Trace not found", status_code=404)
+    return PlainTextResponse(folded_stacks(trace))
+
+# --- JSON API (v1) ---
+# Routes declare response models so FastAPI has Pydantic serialize the
+# records straight to JSON bytes instead of going through jsonable_encoder.
+api_v1 = APIRouter(prefix="/api/v1")
+
+API_BATCH_LIMIT = 500
+
+class LoginRequest(BaseModel):
+    email: str
+    password: str
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class ProfileUpdate(BaseModel):
+    full_name: Optional[str] = None
+    email: Optional[EmailStr] = None
+
+class UserCreate(BaseModel):
+    email: EmailStr
+    password: str
+    full_name: str
+    is_admin: bool = False
+
+class UserUpdate(BaseModel):
+    full_name: Optional[str] = None
+    email: Optional[EmailStr] = None
+    is_admin: Optional[bool] = None
+    is_active: Optional[bool] = None
+
+class BatchLookup(BaseModel):
+    ids: List[Union[int, str]] = []
+    emails: List[str] = []
+
+class UserRecord(BaseModel):
+    id: Union[int, str]
+    email: str
+    full_name: Optional[str] = None
+    is_active: bool = True
+    is_admin: bool = False
+    created_at: Optional[datetime] = None
+
+class TokenResponse(BaseModel):
+    access_token: str
+    refresh_token: str
+    token_type: str
+    expires_in: int
+
+class ProfileUpdateResponse(BaseModel):
+    user: UserRecord
+    # Tokens carry the email as subject, so a changed email comes with new ones.
+    tokens: Optional[TokenResponse] = None
+
+def token_response(email: str):
+    return {
+        "access_token": create_access_token({"sub": email}, timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)),
+        "refresh_token": create_refresh_token({"sub": email}),
+        "token_type": "bearer",
+        "expires_in": ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    }
+
+async def api_get_user_by_email(db: Session, email: str, use_filter: bool = True):
+    if DB_BACKEND == "sqlite":
+        return db_interface.get_user_by_email(db, email, use_filter=use_filter)
+    return await db_interface.get_user_by_email(email, use_filter=use_filter)
+
+def api_user_id(user_id: Union[int, str]):
+    """API ids are integers on SQLite and ObjectId strings on MongoDB."""
+    if DB_BACKEND == "sqlite":
+        return int(user_id) if str(user_id).isdigit() else None
+    return str(user_id)
+
+async def api_get_user_by_id(db: Session, user_id: str):
+    parsed_id = api_user_id(user_id)
+    if parsed_id is None:
+        return None
+    if DB_BACKEND == "sqlite":
+        return db_interface.get_user_by_id(db, parsed_id)
+    return await db_interface.get_user_by_id(parsed_id)
+
+async def api_update_user(db: Session, email: str, update_data: dict):
+    if DB_BACKEND == "sqlite":
+        db_interface.update_user(db, email, update_data)
+    else:
+        await db_interface.update_user(email, update_data)
+    return db_interface.user_record(await api_get_user_by_email(db, update_data.get("email", email), use_filter=False))
+
+async def get_api_user(credentials: HTTPAuthorizationCredentials = Depends(security), db: Session = Depends(get_db)):
+    email = verify_token(credentials.credentials)
+    user = await api_get_user_by_email(db, email) if email else None
+    record = db_interface.user_record(user)
+    if not record or not record["is_active"]:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token", headers={"WWW-Authenticate": "Bearer"})
+    return record
+
+async def get_api_admin(current: dict = Depends(get_api_user)):
+    if not current["is_admin"]:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin privileges required")
+    return current
+
+@api_v1.post("/auth/login", response_model=TokenResponse)
+async def api_login(body: LoginRequest, db: Session = Depends(get_db)):
+    user = await api_get_user_by_email(db, body.email)
+    password_hash = (user.password_hash if DB_BACKEND == "sqlite" else user["password_hash"]) if user else None
+    if not password_hash or not verify_password(body.password, password_hash):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid email or password")
+    record = db_interface.user_record(user)
+    if not record["is_active"]:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Account is disabled")
+    return token_response(record["email"])
+
+@api_v1.post("/auth/refresh", response_model=TokenResponse)
+async def api_refresh(body: RefreshRequest, db: Session = Depends(get_db)):
+    email = verify_token(body.refresh_token, token_type="refresh")
+    record = db_interface.user_record(await api_get_user_by_email(db, email)) if email else None
+    if not record or not record["is_active"]:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired refresh token")
+    return token_response(record["email"])
+
+@api_v1.get("/me", response_model=UserRecord)
+async def api_profile(current: dict = Depends(get_api_user)):
+    return current
+
+@api_v1.patch("/me", response_model=ProfileUpdateResponse)
+async def api_update_profile(body: ProfileUpdate, current: dict = Depends(get_api_user), db: Session = Depends(get_db)):
+    update_data = body.model_dump(exclude_none=True)
+    if "email" in update_data:
+        existing = db_interface.user_record(await api_get_user_by_email(db, update_data["email"], use_filter=False))
+        if existing and existing["id"] != current["id"]:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already in use")
+    if not update_data:
+        return {"user": current}
+    record = await api_update_user(db, current["email"], update_data)
+    tokens = token_response(record["email"]) if record["email"] != current["email"] else None
+    return {"user": record, "tokens": tokens}
+
+@api_v1.get("/users", response_model=List[UserRecord])
+async def api_list_users(admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    if DB_BACKEND == "sqlite":
+        return db_interface.get_user_records(db)
+    return await db_interface.get_user_records()
+
+@api_v1.post("/users", status_code=status.HTTP_201_CREATED, response_model=UserRecord)
+async def api_create_user(body: UserCreate, admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    # MongoDB has no unique email index, so only SQLite may trust the filter.
+    if await api_get_user_by_email(db, body.email, use_filter=DB_BACKEND != "sqlite"):
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already registered")
+    user_data = {
+        "email": body.email,
+        "password_hash": get_password_hash(body.password),
+        "full_name": body.full_name,
+        "is_admin": body.is_admin,
+        "is_active": True,
+        "created_at": datetime.utcnow()
+    }
+    if DB_BACKEND == "sqlite":
+        user = create_sqlite_user(db, user_data)
+        if not user:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already registered")
+        return db_interface.user_record(user)
+    await db_interface.create_user(user_data)
+    return db_interface.user_record(await db_interface.get_user_by_email(body.email, use_filter=False))
+
+@api_v1.post("/users/batch", response_model=List[UserRecord])
+async def api_batch_users(body: BatchLookup, admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    if len(body.ids) + len(body.emails) > API_BATCH_LIMIT:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"At most {API_BATCH_LIMIT} ids and emails per request")
+    ids = [user_id for user_id in map(api_user_id, body.ids) if user_id is not None]
+    if DB_BACKEND == "sqlite":
+        return db_interface.get_users_by_ids_or_emails(db, ids, body.emails)
+    return await db_interface.get_users_by_ids_or_emails(ids, body.emails)
+
+@api_v1.get("/users/{user_id}", response_model=UserRecord)
+async def api_get_user(user_id: str, admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    record = db_interface.user_record(await api_get_user_by_id(db, user_id))
+    if not record:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    return record
+
+@api_v1.patch("/users/{user_id}", response_model=UserRecord)
+async def api_update_user_by_id(user_id: str, body: UserUpdate, admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    record = db_interface.user_record(await api_get_user_by_id(db, user_id))
+    if not record:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    update_data = body.model_dump(exclude_none=True)
+    if "email" in update_data:
+        existing = db_interface.user_record(await api_get_user_by_email(db, update_data["email"], use_filter=False))
+        if existing and existing["id"] != record["id"]:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Email already in use")
+    if not update_data:
+        return record
+    return await api_update_user(db, record["email"], update_data)
+
+@api_v1.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def api_delete_user(user_id: str, admin: dict = Depends(get_api_admin), db: Session = Depends(get_db)):
+    record = db_interface.user_record(await api_get_user_by_id(db, user_id))
+    if not record:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="User not found")
+    if record["id"] == admin["id"]:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="You cannot delete yourself")
+    if DB_BACKEND == "sqlite":
+        db_interface.delete_user(db, record["email"])
+    else:
+        await db_interface.delete_user(record["email"])
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
+app.include_router(api_v1)
@@ -0,0 +1,218 @@
+import os
+import sys
+import time
+import asyncio
+import random
+import threading
+import itertools
+from collections import deque, Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional, Dict, Any, List
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# On-demand request profiling. While disabled the middleware only checks a
+# flag; the stack sampler and SQLAlchemy listeners exist only while enabled.
+PROFILING_BUFFER_SIZE = int(os.getenv("PROFILING_BUFFER_SIZE", "50"))
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "5"))
+# The profiler's own endpoints are never profiled, so reading traces does
+# not push real slow requests out of the ring buffer.
+PROFILING_ENDPOINTS = "/admin/profiling"
+
+_active_trace: ContextVar[Optional["RequestTrace"]] = ContextVar("active_trace", default=None)
+
+
+class StackSampler(threading.Thread):
+    """Samples the event loop thread into folded ``a;b;c`` keys for one request.
+
+    The loop interleaves every in-flight request, so a sample only counts
+    when the request's own task is running; the rest are tallied as idle
+    (loop waiting, or the request is in the thread pool) or other-request.
+    """
+
+    def __init__(self, thread_id: int, interval: float, loop: asyncio.AbstractEventLoop, task: Optional[asyncio.Task]):
+        super().__init__(name="profiling-sampler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.loop = loop
+        self.task = task
+        self.stacks: Counter = Counter()
+        self.idle_samples = 0
+        self.other_samples = 0
+        self._stopped = False
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            current = asyncio.current_task(self.loop)
+            frame = sys._current_frames().get(self.thread_id)
+            with self._lock:
+                if self._stopped:
+                    return
+                if current is None or frame is None:
+                    self.idle_samples += 1
+                    continue
+                if current is not self.task:
+                    self.other_samples += 1
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+
+    def stop(self):
+        # Called on the event loop: flag and return instead of joining, the
+        # daemon thread exits at its next wake-up without touching the counts.
+        with self._lock:
+            self._stopped = True
+            self._stop_event.set()
+            return Counter(self.stacks), self.idle_samples, self.other_samples
+
+
+class RequestTrace:
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.started_at = datetime.utcnow()
+        self.start = time.perf_counter()
+        self.sql: List[Dict[str, Any]] = []
+        self.stacks: Counter = Counter()
+        self.idle_samples = 0
+        self.other_samples = 0
+
+    def to_dict(self, trace_id: int, status_code: int, duration_ms: float) -> Dict[str, Any]:
+        return {
+            "id": trace_id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": status_code,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration_ms, 2),
+            "sql": self.sql,
+            "samples": sum(self.stacks.values()),
+            "idle_samples": self.idle_samples,
+            "other_request_samples": self.other_samples,
+            "stacks": dict(self.stacks),
+        }
+
+
+# The start time lives on the execution context, which is discarded with the
+# statement, so a query that raises leaves nothing behind on the connection.
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and _active_trace.get() is not None:
+        context._profiling_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    trace = _active_trace.get()
+    start = getattr(context, "_profiling_start", None)
+    if trace is None or start is None:
+        return
+    trace.sql.append({"statement": statement, "duration_ms": round((time.perf_counter() - start) * 1000, 3)})
+
+
+class RequestProfiler:
+    """Admin-controlled sampling profiler keeping the last N slow requests."""
+
+    def __init__(self, buffer_size: int = PROFILING_BUFFER_SIZE, interval_ms: float = PROFILING_INTERVAL_MS):
+        self.enabled = False
+        self.sample_rate = 0.0
+        self.path_prefix: Optional[str] = None
+        self.threshold_ms = 500.0
+        self.interval_ms = interval_ms
+        self.traces: deque = deque(maxlen=buffer_size)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: Optional[bool] = None, sample_rate: Optional[float] = None, path_prefix: Optional[str] = None, threshold_ms: Optional[float] = None):
+        """Settings left as None keep their current value; path_prefix="" clears it."""
+        if sample_rate is not None:
+            self.sample_rate = min(max(sample_rate, 0.0), 1.0)
+        if path_prefix is not None:
+            self.path_prefix = path_prefix or None
+        if threshold_ms is not None:
+            self.threshold_ms = max(threshold_ms, 0.0)
+        if enabled is None:
+            return
+        if enabled and not self.enabled:
+            event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+        elif not enabled and self.enabled:
+            event.remove(Engine, "before_cursor_execute", _before_cursor_execute)
+            event.remove(Engine, "after_cursor_execute", _after_cursor_execute)
+        self.enabled = enabled
+
+    def should_profile(self, path: str) -> bool:
+        if path.startswith(PROFILING_ENDPOINTS):
+            return False
+        if self.path_prefix and path.startswith(self.path_prefix):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    async def profile(self, app, scope, receive, send):
+        trace = RequestTrace(scope["method"], scope["path"])
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        token = _active_trace.set(trace)
+        sampler = StackSampler(threading.get_ident(), self.interval_ms / 1000, asyncio.get_running_loop(), asyncio.current_task())
+        sampler.start()
+        try:
+            await app(scope, receive, send_with_status)
+        finally:
+            trace.stacks, trace.idle_samples, trace.other_samples = sampler.stop()
+            _active_trace.reset(token)
+            duration_ms = (time.perf_counter() - trace.start) * 1000
+            if duration_ms >= self.threshold_ms:
+                with self._lock:
+                    self.traces.append(trace.to_dict(next(self._ids), status_code, duration_ms))
+
+    def get_trace(self, trace_id: int) -> Optional[Dict[str, Any]]:
+        return next((trace for trace in list(self.traces) if trace["id"] == trace_id), None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "path_prefix": self.path_prefix,
+            "threshold_ms": self.threshold_ms,
+            "interval_ms": self.interval_ms,
+            "buffer_size": self.traces.maxlen,
+            "traces": [
+                {k: v for k, v in trace.items() if k not in ("sql", "stacks")} | {"queries": len(trace["sql"])}
+                for trace in reversed(list(self.traces))
+            ],
+        }
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware; when profiling is off it only checks a flag."""
+
+    def __init__(self, app, profiler: Optional[RequestProfiler] = None):
+        self.app = app
+        self.profiler = profiler
+
+    async def __call__(self, scope, receive, send):
+        active = self.profiler or profiler
+        if not active.enabled or scope["type"] != "http" or not active.should_profile(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+        await active.profile(self.app, scope, receive, send)
+
+
+def folded_stacks(trace: Dict[str, Any]) -> str:
+    """Render a trace's samples in the folded format used by flamegraph.pl and speedscope."""
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(trace["stacks"].items()))
+
+
+profiler = RequestProfiler()
@@ -0,0 +1,108 @@
+"""Copy users from one set of SQLite databases into a new set of shards.
+
+Run with the app stopped, then point SQLITE_SHARDS/SQLITE_SHARD_URL at the
+target. Examples:
+
+    # split the existing auth.db into 4 shards
+    python reshard.py --source sqlite:///./auth.db --shards 4
+
+    # grow 4 shards to 8 under a new file name
+    python reshard.py --source-template "sqlite:///./auth_shard_{shard}.db" --source-shards 4 \
+        --shards 8 --target "sqlite:///./auth8_shard_{shard}.db"
+"""
+import argparse
+import sys
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import SQLAlchemyError
+
+from db_interface import ShardedSQLiteBackend, shard_urls
+from models import User
+
+BATCH_SIZE = 1000
+
+
+def iter_source_rows(urls):
+    columns = [column.name for column in User.__table__.columns]
+    for url in urls:
+        engine = create_engine(url)
+        with engine.connect() as conn:
+            for row in conn.execute(User.__table__.select()).yield_per(BATCH_SIZE):
+                yield dict(zip(columns, row))
+        engine.dispose()
+
+
+def reshard(source_urls, target_urls, force: bool = False):
+    """Return (copied, skipped); skipped rows already existed in the target."""
+    overlap = set(source_urls) & set(target_urls)
+    if overlap:
+        raise ValueError(f"Target overlaps source: {', '.join(sorted(overlap))}")
+    target = ShardedSQLiteBackend(target_urls)
+    existing = target.count_users(None)
+    if existing and not force:
+        raise ValueError("Target shards already contain users; pass --force to merge into them")
+
+    # Ids must stay unique across all shards, which no single shard's
+    # constraint enforces; emails are unique within the shard they hash to,
+    # so OR IGNORE covers those. Duplicates are skipped instead of aborting
+    # a forced merge (or a rerun after a failure) halfway.
+    seen_ids = {user_id for ids in target.fan_out(lambda db: [row.id for row in db.query(User.id)]) for user_id in ids}
+    insert = User.__table__.insert().prefix_with("OR IGNORE")
+    batches = {shard: [] for shard in range(len(target_urls))}
+    read = 0
+    copied = 0
+
+    def flush(shard):
+        nonlocal copied
+        if batches[shard]:
+            with target.session(shard) as db:
+                copied += db.execute(insert, batches[shard]).rowcount
+                db.commit()
+            batches[shard] = []
+
+    for row in iter_source_rows(source_urls):
+        read += 1
+        if row["id"] in seen_ids:
+            continue
+        seen_ids.add(row["id"])
+        shard = target.shard_for(row["email"])
+        batches[shard].append(row)
+        if len(batches[shard]) >= BATCH_SIZE:
+            flush(shard)
+    for shard in batches:
+        flush(shard)
+
+    total = target.count_users(None)
+    if total != existing + copied:
+        raise RuntimeError(f"Inserted {copied} users into {existing} existing but target holds {total}")
+    # Copied rows keep their ids; new ids must start above them.
+    target.seed_id_sequences()
+    return copied, read - copied
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Redistribute users across SQLite shards by email hash.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--source", action="append", help="source database URL (repeatable)")
+    source.add_argument("--source-template", help="source shard URL template containing {shard}")
+    parser.add_argument("--source-shards", type=int, default=1, help="number of shards for --source-template")
+    parser.add_argument("--shards", type=int, required=True, help="number of target shards")
+    parser.add_argument("--target", default="sqlite:///./auth_shard_{shard}.db", help="target shard URL template containing {shard}")
+    parser.add_argument("--force", action="store_true", help="allow copying into non-empty target shards")
+    args = parser.parse_args(argv)
+
+    source_urls = args.source or shard_urls(args.source_template, args.source_shards)
+    target_urls = shard_urls(args.target, args.shards)
+    try:
+        copied, skipped = reshard(source_urls, target_urls, force=args.force)
+    except (ValueError, RuntimeError, SQLAlchemyError) as e:
+        print(f"Resharding failed: {e}", file=sys.stderr)
+        return 1
+    print(f"Copied {copied} users into {args.shards} shards ({args.target})")
+    if skipped:
+        print(f"Skipped {skipped} users already present in the target (same id or email)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
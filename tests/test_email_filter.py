@@ -0,0 +1,94 @@
+import random
+
+from email_filter import CountingBloomFilter, EmailFilter, _COUNTER_MAX
+
+
+def make_filter(emails=(), capacity=1000):
+    email_filter = EmailFilter(enabled=True, capacity=capacity, fp_rate=0.01, workers=1)
+    email_filter.rebuild(list(emails), len(emails))
+    return email_filter
+
+
+def test_lookups_are_normalized():
+    email_filter = make_filter(["Alice@Example.com "])
+    assert email_filter.might_contain("alice@example.com")
+    assert email_filter.might_contain("ALICE@EXAMPLE.COM")
+
+
+def test_churn_never_hides_stored_emails():
+    # Small filter so counters are shared between many emails.
+    email_filter = make_filter(capacity=50)
+    rng = random.Random(0)
+    stored = set()
+    for step in range(5000):
+        action = rng.random()
+        if stored and action < 0.3:
+            email = rng.choice(sorted(stored))
+            email_filter.remove(email)
+            stored.discard(email)
+        elif stored and action < 0.5:
+            old = rng.choice(sorted(stored))
+            new = f"renamed{step}@example.com"
+            email_filter.replace(old, new)
+            stored.discard(old)
+            stored.add(new)
+        else:
+            email = f"user{step}@example.com"
+            email_filter.add(email)
+            stored.add(email)
+        if step % 100 == 0:
+            assert all(email_filter.might_contain(email) for email in stored)
+    assert all(email_filter.might_contain(email) for email in stored)
+
+
+def test_removed_emails_are_reported_missing():
+    email_filter = make_filter(["a@example.com", "b@example.com"])
+    email_filter.remove("a@example.com")
+    assert not email_filter.might_contain("a@example.com")
+    assert email_filter.might_contain("b@example.com")
+
+
+def test_remove_keeps_saturated_counters():
+    bloom = CountingBloomFilter(10, 0.01)
+    email = "hot@example.com"
+    for _ in range(_COUNTER_MAX + 10):
+        bloom.add(email)
+    for pos in bloom._positions(email):
+        assert bloom.counters[pos] == _COUNTER_MAX
+    for _ in range(_COUNTER_MAX + 10):
+        bloom.remove(email)
+    assert email in bloom
+
+
+def test_remove_of_unknown_email_leaves_others():
+    bloom = CountingBloomFilter(100, 0.01)
+    bloom.add("kept@example.com")
+    bloom.remove("never-added@example.com")
+    assert "kept@example.com" in bloom
+
+
+def test_rebuild_replays_adds_and_skips_removes():
+    email_filter = make_filter(["old@example.com", "gone@example.com"])
+
+    def stream():
+        yield "streamed@example.com"
+        email_filter.add("added-during@example.com")
+        email_filter.remove("old@example.com")
+        yield "gone@example.com"
+
+    email_filter.rebuild(stream())
+    assert email_filter.might_contain("streamed@example.com")
+    assert email_filter.might_contain("added-during@example.com")
+    assert email_filter.might_contain("gone@example.com")
+    # Not in the new stream, so the new filter no longer holds it.
+    assert not email_filter.might_contain("old@example.com")
+    # Removes work again once the rebuild is done.
+    email_filter.remove("gone@example.com")
+    assert not email_filter.might_contain("gone@example.com")
+
+
+def test_disabled_with_multiple_workers():
+    email_filter = EmailFilter(enabled=True, workers=4)
+    email_filter.rebuild(["a@example.com"])
+    assert not email_filter.enabled
+    assert email_filter.might_contain("anything@example.com")
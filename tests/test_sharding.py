@@ -0,0 +1,78 @@
+import threading
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from db_interface import ShardedSQLiteBackend, shard_urls, SHARD_ID_BITS
+from models import Base, User
+from reshard import reshard
+
+
+def make_backend(tmp_path, count, name="shard"):
+    return ShardedSQLiteBackend(shard_urls(f"sqlite:///{tmp_path}/{name}_{{shard}}.db", count))
+
+
+def user_data(email):
+    return {"email": email, "password_hash": "", "full_name": "Test User"}
+
+
+def test_ids_unique_in_tight_loop(tmp_path):
+    backend = make_backend(tmp_path, 4)
+    ids = [backend.create_user(None, user_data(f"user{i}@example.com")).id for i in range(3000)]
+    assert len(set(ids)) == len(ids)
+    assert all(user_id < 2 ** 53 for user_id in ids)
+
+
+def test_ids_unique_across_threads(tmp_path):
+    backend = make_backend(tmp_path, 4)
+    ids = []
+    lock = threading.Lock()
+
+    def write(worker):
+        created = [backend.create_user(None, user_data(f"w{worker}-{i}@example.com")).id for i in range(300)]
+        with lock:
+            ids.extend(created)
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(ids) == 2400
+    assert len(set(ids)) == len(ids)
+
+
+def test_ids_encode_shard_index(tmp_path):
+    backend = make_backend(tmp_path, 4)
+    for i in range(50):
+        email = f"user{i}@example.com"
+        user = backend.create_user(None, user_data(email))
+        assert user.id & ((1 << SHARD_ID_BITS) - 1) == backend.shard_for(email)
+
+
+def test_ids_after_reshard_stay_above_copied_ids(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/auth.db")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([User(id=i, **user_data(f"old{i}@example.com")) for i in range(1, 500)])
+    db.commit()
+    db.close()
+
+    copied, skipped = reshard([f"sqlite:///{tmp_path}/auth.db"], shard_urls(f"sqlite:///{tmp_path}/shard_{{shard}}.db", 3))
+    assert (copied, skipped) == (499, 0)
+
+    backend = make_backend(tmp_path, 3)
+    new_ids = [backend.create_user(None, user_data(f"new{i}@example.com")).id for i in range(200)]
+    assert min(new_ids) > 499
+    assert len(set(new_ids)) == len(new_ids)
+
+
+def test_forced_reshard_skips_existing_users(tmp_path):
+    source = make_backend(tmp_path, 2, "source")
+    for i in range(20):
+        source.create_user(None, user_data(f"user{i}@example.com"))
+    target_urls = shard_urls(f"sqlite:///{tmp_path}/target_{{shard}}.db", 3)
+
+    assert reshard(source.urls, target_urls) == (20, 0)
+    assert reshard(source.urls, target_urls, force=True) == (0, 20)
+    assert make_backend(tmp_path, 3, "target").count_users(None) == 20